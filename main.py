@@ -1,16 +1,24 @@
 import uvicorn 
 from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from firebase_admin import credentials, initialize_app, auth, firestore
 from pydantic import BaseModel, Field
 from typing import List, Optional
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import requests
 import os
 from dotenv import load_dotenv
 import json
 import time
+import threading
+import functools
+import itertools
+import csv
+import uuid
+import io
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables from .env file
 load_dotenv()
@@ -93,6 +101,11 @@ class Notification(BaseModel):
     fechaEnvio: datetime
     leido: bool
 
+class AttendanceReportRequest(BaseModel):
+    fechaInicio: datetime
+    fechaFin: datetime
+    gradoIds: List[str]
+
 # Secret key and algorithm for JWT
 token_secret_key = "your_secret_key"
 token_algorithm = "HS256"
@@ -122,6 +135,105 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
+# Single-flight: peticiones idénticas concurrentes (misma ruta y parámetros) comparten
+# una sola ejecución. Opcionalmente el resultado se guarda unos segundos (microcache).
+single_flight_cache_seconds = float(os.getenv("SINGLE_FLIGHT_CACHE_SECONDS", "0"))
+single_flight_cache_max_entries = int(os.getenv("SINGLE_FLIGHT_CACHE_MAX_ENTRIES", "256"))
+single_flight_lock = threading.Lock()
+single_flight_inflight = {}
+single_flight_cache = {}
+single_flight_metrics = {"requests": 0, "executions": 0, "coalesced": 0, "cache_hits": 0, "errors": 0, "evictions": 0}
+
+def single_flight_key(route: str, params: dict):
+    normalized = sorted((name, str(value)) for name, value in params.items())
+    return f"{route}?{json.dumps(normalized)}"
+
+def purge_single_flight_cache(now: float):
+    # Se llama con single_flight_lock tomado
+    for key in [key for key, (expires, _) in single_flight_cache.items() if expires <= now]:
+        del single_flight_cache[key]
+
+def store_single_flight_cache(key: str, result):
+    # Se llama con single_flight_lock tomado. Todas las entradas usan la misma ventana, así que el
+    # orden de inserción del dict coincide con el de vencimiento y la primera es la más antigua.
+    now = time.monotonic()
+    purge_single_flight_cache(now)
+    single_flight_cache.pop(key, None)
+    while single_flight_cache and len(single_flight_cache) >= single_flight_cache_max_entries:
+        del single_flight_cache[next(iter(single_flight_cache))]
+        single_flight_metrics["evictions"] += 1
+    single_flight_cache[key] = (now + single_flight_cache_seconds, result)
+
+def single_flight(route: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(**kwargs):
+            key = single_flight_key(route, kwargs)
+            with single_flight_lock:
+                single_flight_metrics["requests"] += 1
+                cached = single_flight_cache.get(key)
+                if cached:
+                    if cached[0] > time.monotonic():
+                        single_flight_metrics["cache_hits"] += 1
+                        return cached[1]
+                    del single_flight_cache[key]
+                call = single_flight_inflight.get(key)
+                leader = call is None
+                if leader:
+                    call = {"event": threading.Event(), "result": None, "error": None, "stale": False}
+                    single_flight_inflight[key] = call
+                    single_flight_metrics["executions"] += 1
+                else:
+                    single_flight_metrics["coalesced"] += 1
+
+            if not leader:
+                call["event"].wait()
+                if call["error"] is not None:
+                    raise call["error"]
+                return call["result"]
+
+            try:
+                call["result"] = func(**kwargs)
+            except Exception as e:
+                call["error"] = e
+                with single_flight_lock:
+                    single_flight_metrics["errors"] += 1
+                raise
+            finally:
+                with single_flight_lock:
+                    if single_flight_inflight.get(key) is call:
+                        del single_flight_inflight[key]
+                    if call["error"] is None and not call["stale"] and single_flight_cache_seconds > 0 and single_flight_cache_max_entries > 0:
+                        store_single_flight_cache(key, call["result"])
+                call["event"].set()
+            return call["result"]
+        return wrapper
+    return decorator
+
+def invalidate_single_flight(*routes: str):
+    """
+    Descarta los resultados en microcache y en curso de las rutas indicadas tras una escritura.
+    """
+    prefixes = tuple(f"{route}?" for route in routes)
+    with single_flight_lock:
+        for key in [key for key in single_flight_cache if key.startswith(prefixes)]:
+            del single_flight_cache[key]
+        # Un cálculo que empezó antes de la escritura no debe guardarse ni reutilizarse
+        for key in [key for key in single_flight_inflight if key.startswith(prefixes)]:
+            single_flight_inflight.pop(key)["stale"] = True
+
+@app.get("/metrics/single-flight")
+def get_single_flight_metrics():
+    with single_flight_lock:
+        purge_single_flight_cache(time.monotonic())
+        return {
+            **single_flight_metrics,
+            "inFlight": len(single_flight_inflight),
+            "cachedEntries": len(single_flight_cache),
+            "cacheSeconds": single_flight_cache_seconds,
+            "cacheMaxEntries": single_flight_cache_max_entries,
+        }
+
 # Authentication Endpoints
 @app.post("/auth/register")
 def register_user(user: User):
@@ -144,6 +256,7 @@ def register_user(user: User):
     user_data["uid"] = firebase_user.uid
     user_data["fechaCreacion"] = datetime.utcnow()  # Automatically set creation date
     db.collection("users").document(firebase_user.uid).set(user_data)
+    invalidate_single_flight("GET /relations/available-options")
 
     return {"message": "User registered successfully", "userId": firebase_user.uid}
 
@@ -168,6 +281,7 @@ def edit_profile(user_id: str, user: User):
 
     # Update user details in Firestore
     user_ref.update(user.dict())
+    invalidate_single_flight("GET /relations/available-options")
 
     # Update Firebase Auth user
     auth.update_user(
@@ -178,10 +292,90 @@ def edit_profile(user_id: str, user: User):
 
     return {"message": "Profile updated successfully"}
 
+# Grade rosters: documento desnormalizado por grado (grade_rosters/{gradoId})
+# con un mapa compacto de alumnos, para que las vistas de clase cuesten una sola lectura.
+def build_roster_entry(student_data: dict):
+    return {
+        "nombreCompleto": f"{student_data.get('nombre', '')} {student_data.get('apellido', '')}",
+        "gender": student_data.get("gender"),
+        "turno": student_data.get("turno"),
+        "activo": student_data.get("activo"),
+    }
+
+def upsert_roster_entry(gradoId: str, student_id: str, student_data: dict):
+    roster_ref = db.collection("grade_rosters").document(gradoId)
+    if not roster_ref.get().exists:
+        # Sin roster previo, un merge dejaría solo a este alumno: se construye completo
+        # (el alumno ya está guardado en `students`, así que queda incluido)
+        rebuild_grade_roster(gradoId)
+        return
+    roster_ref.set(
+        {"gradoId": gradoId, "students": {student_id: build_roster_entry(student_data)}}, merge=True
+    )
+
+def remove_roster_entry(gradoId: str, student_id: str):
+    roster_ref = db.collection("grade_rosters").document(gradoId)
+    if roster_ref.get().exists:
+        roster_ref.update({firestore.FieldPath("students", student_id).to_api_repr(): firestore.DELETE_FIELD})
+
+def rebuild_grade_roster(gradoId: str):
+    roster = {
+        doc.id: build_roster_entry(doc.to_dict())
+        for doc in db.collection("students").where("gradoId", "==", gradoId).stream()
+    }
+    roster_ref = db.collection("grade_rosters").document(gradoId)
+    if roster:
+        # set sin merge reemplaza el mapa completo y elimina entradas huérfanas
+        roster_ref.set({"gradoId": gradoId, "students": roster})
+    else:
+        # Sin alumnos no se guarda nada, así un gradoId inexistente no deja documentos basura
+        roster_ref.delete()
+    return roster
+
+def get_grade_roster(gradoId: str):
+    """
+    Retorna la lista compacta de alumnos del grado, reconstruyendo el roster si aún no existe
+    (los grados sin alumnos no tienen roster y devuelven una lista vacía).
+    """
+    roster_doc = db.collection("grade_rosters").document(gradoId).get()
+    roster = roster_doc.to_dict().get("students", {}) if roster_doc.exists else rebuild_grade_roster(gradoId)
+    return [{"id": student_id, **roster[student_id]} for student_id in sorted(roster)]
+
+@app.post("/grade-rosters/{gradoId}/rebuild")
+def rebuild_grade_roster_endpoint(gradoId: str):
+    roster = rebuild_grade_roster(gradoId)
+    invalidate_single_flight("GET /students/by-grado/{gradoId}")
+    return {"gradoId": gradoId, "students": len(roster), "message": "Roster rebuilt successfully"}
+
+@app.post("/grade-rosters/rebuild")
+def rebuild_all_grade_rosters():
+    """
+    Reconstruye los rosters de todos los grados para reparar desviaciones.
+    """
+    rosters = {}
+    for doc in db.collection("students").stream():
+        student_data = doc.to_dict()
+        gradoId = student_data.get("gradoId")
+        if gradoId:
+            rosters.setdefault(gradoId, {})[doc.id] = build_roster_entry(student_data)
+
+    # Eliminar rosters de grados que ya no tienen alumnos
+    for doc in db.collection("grade_rosters").stream():
+        if doc.id not in rosters:
+            doc.reference.delete()
+
+    for gradoId, roster in rosters.items():
+        db.collection("grade_rosters").document(gradoId).set({"gradoId": gradoId, "students": roster})
+
+    invalidate_single_flight("GET /students/by-grado/{gradoId}")
+    return {"grades": len(rosters), "message": "Rosters rebuilt successfully"}
+
 # CRUD for Students
 @app.post("/students")
 def create_student(student: Student):
     student_ref = db.collection("students").add(student.dict())
+    upsert_roster_entry(student.gradoId, student_ref[1].id, student.dict())
+    invalidate_single_flight("GET /students/by-grado/{gradoId}", "GET /relations/available-options", "GET /attendance/summary")
     return {"id": student_ref[1].id, "message": "Student created successfully"}
 
 @app.get("/students")
@@ -215,17 +409,31 @@ def get_student(student_id: str):
 @app.put("/students/{student_id}")
 def update_student(student_id: str, student: Student):
     student_ref = db.collection("students").document(student_id)
-    if not student_ref.get().exists:
+    existing_student = student_ref.get()
+    if not existing_student.exists:
         raise HTTPException(status_code=404, detail="Student not found")
     student_ref.update(student.dict())
+
+    # Mantener el roster al día, moviendo al alumno si cambió de grado
+    previous_gradoId = existing_student.to_dict().get("gradoId")
+    if previous_gradoId and previous_gradoId != student.gradoId:
+        remove_roster_entry(previous_gradoId, student_id)
+    upsert_roster_entry(student.gradoId, student_id, student.dict())
+    invalidate_single_flight("GET /students/by-grado/{gradoId}", "GET /relations/available-options", "GET /attendance/summary")
     return {"message": "Student updated successfully"}
 
 @app.delete("/students/{student_id}")
 def delete_student(student_id: str):
     student_ref = db.collection("students").document(student_id)
-    if not student_ref.get().exists:
+    existing_student = student_ref.get()
+    if not existing_student.exists:
         raise HTTPException(status_code=404, detail="Student not found")
     student_ref.delete()
+
+    gradoId = existing_student.to_dict().get("gradoId")
+    if gradoId:
+        remove_roster_entry(gradoId, student_id)
+    invalidate_single_flight("GET /students/by-grado/{gradoId}", "GET /relations/available-options", "GET /attendance/summary")
     return {"message": "Student deleted successfully"}
 
 # User Endpoints
@@ -272,6 +480,7 @@ def update_user(user_id: str, user: User):
     if not user_ref.get().exists:
         raise HTTPException(status_code=404, detail="User not found")
     user_ref.update(user.dict())
+    invalidate_single_flight("GET /relations/available-options")
     return {"message": "User updated successfully"}
 
 @app.delete("/users/{user_id}")
@@ -280,6 +489,7 @@ def delete_user(user_id: str):
     if not user_ref.get().exists:
         raise HTTPException(status_code=404, detail="User not found")
     user_ref.delete()
+    invalidate_single_flight("GET /relations/available-options")
     return {"message": "User deleted successfully"}
 
 
@@ -297,15 +507,12 @@ def get_users_by_role(rol: str):
 
 # Endpoint to get students by grade ID
 @app.get("/students/by-grado/{gradoId}")
+@single_flight("GET /students/by-grado/{gradoId}")
 def get_students_by_grado(gradoId: str):
     """
-    Retorna todos los alumnos que pertenecen al grado especificado.
+    Retorna todos los alumnos que pertenecen al grado especificado desde su roster.
     """
-    students = [
-        {"id": doc.id, **doc.to_dict()}
-        for doc in db.collection("students").where("gradoId", "==", gradoId).stream()
-    ]
-    return students
+    return get_grade_roster(gradoId)
 
 # Endpoint to get students by shift (turno)
 @app.get("/students/by-turno/{turno}")
@@ -321,6 +528,7 @@ def get_students_by_turno(turno: str):
 
 # Endpoint to get available options for tutor-student relations
 @app.get("/relations/available-options")
+@single_flight("GET /relations/available-options")
 def get_available_options():
     # Fetch students
     students = [
@@ -410,9 +618,11 @@ def delete_tutor_student_relation(relation_id: str):
 @app.post("/grades")
 def create_grade(grade: Grade):
     grade_ref = db.collection("grades").add(grade.dict())
+    invalidate_single_flight("GET /grades")
     return {"id": grade_ref[1].id, "message": "Grade created successfully"}
 
 @app.get("/grades")
+@single_flight("GET /grades")
 def get_grades():
     grades = [
         {"id": doc.id, **doc.to_dict()} for doc in db.collection("grades").stream()
@@ -432,6 +642,7 @@ def update_grade(grade_id: str, grade: Grade):
     if not grade_ref.get().exists:
         raise HTTPException(status_code=404, detail="Grade not found")
     grade_ref.update(grade.dict())
+    invalidate_single_flight("GET /grades")
     return {"message": "Grade updated successfully"}
 
 @app.delete("/grades/{grade_id}")
@@ -440,6 +651,8 @@ def delete_grade(grade_id: str):
     if not grade_ref.get().exists:
         raise HTTPException(status_code=404, detail="Grade not found")
     grade_ref.delete()
+    db.collection("grade_rosters").document(grade_id).delete()
+    invalidate_single_flight("GET /grades", "GET /students/by-grado/{gradoId}")
     return {"message": "Grade deleted successfully"}
 
 # CRUD for Subjects
@@ -468,6 +681,7 @@ def update_subject(subject_id: str, subject: Subject):
     if not subject_ref.get().exists:
         raise HTTPException(status_code=404, detail="Subject not found")
     subject_ref.update(subject.dict())
+    invalidate_single_flight("GET /attendance/summary")
     return {"message": "Subject updated successfully"}
 
 @app.delete("/subjects/{subject_id}")
@@ -476,6 +690,7 @@ def delete_subject(subject_id: str):
     if not subject_ref.get().exists:
         raise HTTPException(status_code=404, detail="Subject not found")
     subject_ref.delete()
+    invalidate_single_flight("GET /attendance/summary")
     return {"message": "Subject deleted successfully"}
 
 # Endpoint to create multiple relations between a grade and subjects
@@ -562,11 +777,8 @@ def get_students_in_subject(materiaGradoId: str):
 
     gradoId = grade_subject.to_dict()["gradoId"]
 
-    # Fetch students in the grade
-    students = [
-        {"id": doc.id, **doc.to_dict()} for doc in db.collection("students").where("gradoId", "==", gradoId).stream()
-    ]
-    return students
+    # Fetch students in the grade from its roster document
+    return get_grade_roster(gradoId)
 
 # Endpoint to get user-related information
 @app.get("/user/{user_id}/info")
@@ -591,7 +803,8 @@ def get_user_info(user_id: str):
             for subject in grade_subjects:
                 subjects.append(subject.to_dict()["materiaId"])
         notifications = [
-            {"id": doc.id, **doc.to_dict()} for doc in db.collection("notifications").where("tutorId", "==", user_id).stream()
+            {"id": record_id, **notification}
+            for record_id, notification in iter_records_with_archive("notifications", "notifications_archive", "fechaEnvio", filters={"tutorId": user_id})
         ]
         return {
             "user": user_info,
@@ -631,6 +844,7 @@ def mark_attendance(attendance: Attendance):
 
     # Guardar la asistencia
     db.collection("attendance").add(attendance.dict())
+    invalidate_single_flight("GET /attendance/summary")
 
     # Obtener el nombre de la materia
     nombre_materia = subject_doc.to_dict().get("nombre", "una materia")
@@ -654,13 +868,14 @@ def mark_attendance(attendance: Attendance):
     return {"message": "Attendance recorded successfully"}
 
 @app.get("/attendance/summary")
-def get_attendance_summary():
+@single_flight("GET /attendance/summary")
+def get_attendance_summary(fecha_inicio: Optional[datetime] = Query(None), fecha_fin: Optional[datetime] = Query(None)):
     try:
-        attendance_docs = db.collection("attendance").stream()
+        # Incluye los registros archivados cuando el rango lo requiere
+        attendance_records = iter_records_with_archive("attendance", "attendance_archive", "fecha", fecha_inicio, fecha_fin)
         summary = []
 
-        for doc in attendance_docs:
-            att = doc.to_dict()
+        for record_id, att in attendance_records:
 
             # Obtener datos del alumno
             student_ref = db.collection("students").document(att["alumnoId"]).get()
@@ -671,7 +886,7 @@ def get_attendance_summary():
             subject = subject_ref.to_dict() if subject_ref.exists else {}
 
             summary.append({
-                "id": doc.id,
+                "id": record_id,
                 "alumnoId": att["alumnoId"],
                 "nombreAlumno": f"{student.get('nombre', '')} {student.get('apellido', '')}",
                 "gradoId": student.get("gradoId", ""),
@@ -688,11 +903,11 @@ def get_attendance_summary():
 
 
 @app.get("/notifications")
-def get_all_notifications():
+def get_all_notifications(fecha_inicio: Optional[datetime] = Query(None), fecha_fin: Optional[datetime] = Query(None)):
     try:
         notifications = [
-            {"id": doc.id, **doc.to_dict()}
-            for doc in db.collection("notifications").stream()
+            {"id": record_id, **notification}
+            for record_id, notification in iter_records_with_archive("notifications", "notifications_archive", "fechaEnvio", fecha_inicio, fecha_fin)
         ]
         print(f"Endpoint de notificaciones: tiene {len(notifications)} documentos")
         return notifications
@@ -700,6 +915,357 @@ def get_all_notifications():
         raise HTTPException(status_code=500, detail=f"Error fetching notifications: {str(e)}")
 
 
+# Archivado: los registros de asistencia y notificaciones anteriores al corte se agrupan en
+# documentos compactos por alumno y mes ({alumnoId}_{YYYY-MM}) y se eliminan de la colección original.
+archive_retention_days = int(os.getenv("ARCHIVE_RETENTION_DAYS", "365"))
+archive_batch_size = int(os.getenv("ARCHIVE_BATCH_SIZE", "200"))
+# Cada registro usa hasta 2 escrituras (borrado + documento de archivo) y un lote de Firestore admite 500
+if not 1 <= archive_batch_size <= 250:
+    raise RuntimeError("ARCHIVE_BATCH_SIZE must be between 1 and 250")
+
+def as_utc(value: datetime):
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+def get_archived_before(source: str):
+    state = db.collection("archive_state").document(source).get()
+    return state.to_dict().get("archivedBefore") if state.exists else None
+
+def iter_records_with_archive(source: str, archive: str, fecha_field: str, fecha_inicio: Optional[datetime] = None, fecha_fin: Optional[datetime] = None, filters: Optional[dict] = None):
+    """
+    Genera pares (id, datos) de la colección original y, si el rango pedido empieza antes
+    del corte de archivado (o no tiene inicio), también de los documentos archivados.
+    `filters` aplica igualdades campo == valor en ambas fuentes.
+    """
+    filters = filters or {}
+    fecha_inicio = as_utc(fecha_inicio) if fecha_inicio else None
+    fecha_fin = as_utc(fecha_fin) if fecha_fin else None
+
+    live_query = db.collection(source)
+    if fecha_inicio:
+        live_query = live_query.where(fecha_field, ">=", fecha_inicio)
+    if fecha_fin:
+        live_query = live_query.where(fecha_field, "<=", fecha_fin)
+    for field, value in filters.items():
+        live_query = live_query.where(field, "==", value)
+    # Un registro archivado mientras se lee aparecería en ambas fuentes; los ids son únicos entre ellas
+    seen_ids = set()
+    for doc in live_query.stream():
+        seen_ids.add(doc.id)
+        yield doc.id, doc.to_dict()
+
+    for record_id, record in iter_archived_records(source, archive, fecha_field, fecha_inicio, fecha_fin, filters):
+        if record_id not in seen_ids:
+            yield record_id, record
+
+def iter_archived_records(source: str, archive: str, fecha_field: str, fecha_inicio: Optional[datetime] = None, fecha_fin: Optional[datetime] = None, filters: Optional[dict] = None):
+    filters = filters or {}
+    fecha_inicio = as_utc(fecha_inicio) if fecha_inicio else None
+    fecha_fin = as_utc(fecha_fin) if fecha_fin else None
+
+    archived_before = get_archived_before(source)
+    if archived_before is None or (fecha_inicio and fecha_inicio >= archived_before):
+        return
+
+    archive_query = db.collection(archive)
+    if fecha_inicio:
+        archive_query = archive_query.where("mes", ">=", fecha_inicio.strftime("%Y-%m"))
+    if fecha_fin:
+        archive_query = archive_query.where("mes", "<=", fecha_fin.strftime("%Y-%m"))
+    for field, value in filters.items():
+        # alumnoId es campo del documento de archivo; los demás filtros usan su índice `{campo}s`
+        if field == "alumnoId":
+            archive_query = archive_query.where("alumnoId", "==", value)
+        else:
+            archive_query = archive_query.where(f"{field}s", "array_contains", value)
+    for doc in archive_query.stream():
+        archived = doc.to_dict()
+        for record in archived.get("registros", []):
+            fecha = record.get(fecha_field)
+            if (fecha_inicio and fecha < fecha_inicio) or (fecha_fin and fecha > fecha_fin):
+                continue
+            record = {"alumnoId": archived["alumnoId"], **record}
+            if any(record.get(field) != value for field, value in filters.items()):
+                continue
+            record_id = record.pop("id")
+            yield record_id, record
+
+def archive_collection(source: str, archive: str, fecha_field: str, count_field: str, cutoff: datetime, indexed_field: Optional[str] = None):
+    # Registrar el corte antes de mover datos para que las lecturas consulten el archivo durante el proceso
+    archived_before = get_archived_before(source)
+    if archived_before is None or cutoff > archived_before:
+        db.collection("archive_state").document(source).set({"archivedBefore": cutoff})
+
+    archived = 0
+    while True:
+        docs = list(db.collection(source).where(fecha_field, "<", cutoff).limit(archive_batch_size).stream())
+        if not docs:
+            break
+
+        groups = {}
+        for doc in docs:
+            data = doc.to_dict()
+            mes = data[fecha_field].strftime("%Y-%m")
+            group = groups.setdefault(f"{data['alumnoId']}_{mes}", {"alumnoId": data["alumnoId"], "mes": mes, "registros": [], "conteos": {}, "indexados": set()})
+            record = {key: value for key, value in data.items() if key != "alumnoId"}
+            group["registros"].append({"id": doc.id, **record})
+            count_key = str(data.get(count_field, "otro"))
+            group["conteos"][count_key] = group["conteos"].get(count_key, 0) + 1
+            if indexed_field and data.get(indexed_field) is not None:
+                group["indexados"].add(data[indexed_field])
+
+        # El lote es atómico: cada registro queda en el archivo o en la colección original, nunca en ambos
+        batch = db.batch()
+        for archive_id, group in groups.items():
+            archive_data = {
+                "alumnoId": group["alumnoId"],
+                "mes": group["mes"],
+                "registros": firestore.ArrayUnion(group["registros"]),
+                "total": firestore.Increment(len(group["registros"])),
+                "conteos": {key: firestore.Increment(count) for key, count in group["conteos"].items()},
+            }
+            # Índice para filtrar por este campo sin recorrer todo el archivo (p. ej. tutorIds)
+            if group["indexados"]:
+                archive_data[f"{indexed_field}s"] = firestore.ArrayUnion(sorted(group["indexados"]))
+            batch.set(db.collection(archive).document(archive_id), archive_data, merge=True)
+        for doc in docs:
+            batch.delete(doc.reference)
+        batch.commit()
+        archived += len(docs)
+
+    return archived
+
+@app.post("/maintenance/archive")
+def archive_old_records(retention_days: int = Query(archive_retention_days, ge=1)):
+    """
+    Archiva asistencias y notificaciones con más de `retention_days` días de antigüedad.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    try:
+        attendance_archived = archive_collection("attendance", "attendance_archive", "fecha", "estado", cutoff)
+        notifications_archived = archive_collection("notifications", "notifications_archive", "fechaEnvio", "tipo", cutoff, indexed_field="tutorId")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error archiving records: {str(e)}")
+    return {
+        "cutoff": cutoff,
+        "attendanceArchived": attendance_archived,
+        "notificationsArchived": notifications_archived,
+        "message": "Records archived successfully",
+    }
+
+
+# Reportes de asistencia en segundo plano: los trabajos corren en un pool de hilos propio,
+# separado del de las peticiones, y leen Firestore por bloques para acotar la memoria.
+# El estado vive en `report_jobs/{jobId}` y el CSV en su subcolección `chunks`, de modo que
+# cualquier instancia puede consultarlo. Los hilos necesitan un proceso persistente (uvicorn):
+# en plataformas serverless un trabajo puede quedar congelado y se marca como fallido al vencer.
+report_workers = int(os.getenv("REPORT_WORKERS", "2"))
+report_chunk_size = int(os.getenv("REPORT_CHUNK_SIZE", "500"))
+report_rows_per_chunk = int(os.getenv("REPORT_ROWS_PER_CHUNK", "2000"))  # ~150 bytes por fila, lejos del límite de 1 MB por documento
+report_job_ttl_hours = float(os.getenv("REPORT_JOB_TTL_HOURS", "24"))
+report_job_timeout_minutes = float(os.getenv("REPORT_JOB_TIMEOUT_MINUTES", "30"))
+report_executor = ThreadPoolExecutor(max_workers=report_workers, thread_name_prefix="attendance-report")
+
+report_columns = ["gradoId", "alumnoId", "nombreCompleto", "materiaId", "nombreMateria", "total", "presente", "ausente", "justificado", "tasaAusencia"]
+
+def update_report_job(job_id: str, **changes):
+    db.collection("report_jobs").document(job_id).update({**changes, "updatedAt": datetime.now(timezone.utc)})
+
+def transition_report_job(job_id: str, expected_status: str, **changes):
+    """
+    Cambia el estado del trabajo solo si sigue en `expected_status`, para que un trabajo
+    marcado como fallido (p. ej. por vencimiento) nunca vuelva a `completed`.
+    """
+    job_ref = db.collection("report_jobs").document(job_id)
+
+    @firestore.transactional
+    def apply(transaction):
+        job = job_ref.get(transaction=transaction)
+        if not job.exists or job.to_dict().get("status") != expected_status:
+            return False
+        transaction.update(job_ref, {**changes, "updatedAt": datetime.now(timezone.utc)})
+        return True
+
+    return apply(db.transaction())
+
+def delete_report_job(job_ref):
+    for chunk in job_ref.collection("chunks").stream():
+        chunk.reference.delete()
+    job_ref.delete()
+
+def cleanup_expired_report_jobs():
+    """
+    Elimina los trabajos (y su CSV) sin actividad desde hace más de `REPORT_JOB_TTL_HOURS`.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=report_job_ttl_hours)
+    for job in db.collection("report_jobs").where("updatedAt", "<", cutoff).stream():
+        delete_report_job(job.reference)
+
+def iter_attendance_in_chunks(fecha_inicio: datetime, fecha_fin: datetime):
+    query = (
+        db.collection("attendance")
+        .where("fecha", ">=", fecha_inicio)
+        .where("fecha", "<=", fecha_fin)
+        .order_by("fecha")
+        .limit(report_chunk_size)
+    )
+    last_doc = None
+    while True:
+        chunk = list((query.start_after(last_doc) if last_doc else query).stream())
+        for doc in chunk:
+            yield doc.id, doc.to_dict()
+        if len(chunk) < report_chunk_size:
+            break
+        last_doc = chunk[-1]
+
+def write_report_chunk(job_id: str, index: int, rows: list):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    db.collection("report_jobs").document(job_id).collection("chunks").document(f"{index:05d}").set({"index": index, "csv": buffer.getvalue()})
+
+def run_attendance_report(job_id: str, fecha_inicio: datetime, fecha_fin: datetime, gradoIds: List[str]):
+    try:
+        if not transition_report_job(job_id, "pending", status="running", startedAt=datetime.now(timezone.utc)):
+            return  # vencido o eliminado mientras esperaba en la cola
+        students = {}
+        for gradoId in gradoIds:
+            for entry in get_grade_roster(gradoId):
+                students[entry["id"]] = (gradoId, entry["nombreCompleto"])
+
+        # Solo un registro anterior al corte de archivado puede estar a la vez en la lectura en vivo y en
+        # el archivo, así que solo esos ids se recuerdan (normalmente ninguno). Los registros archivados
+        # con fecha posterior a este corte se movieron durante el reporte y ya se contaron en vivo.
+        archived_before = get_archived_before("attendance")
+
+        # Solo se guardan contadores por alumno y materia, nunca los registros completos
+        counters = {}
+        processed = 0
+        live_ids = set()
+        for source, (record_id, att) in itertools.chain(
+            (("live", record) for record in iter_attendance_in_chunks(fecha_inicio, fecha_fin)),
+            (("archive", record) for record in iter_archived_records("attendance", "attendance_archive", "fecha", fecha_inicio, fecha_fin)),
+        ):
+            processed += 1
+            if processed % report_chunk_size == 0:
+                update_report_job(job_id, processedRecords=processed)
+            if att["alumnoId"] not in students:
+                continue
+            if source == "live":
+                if archived_before and att["fecha"] < archived_before:
+                    live_ids.add(record_id)
+            elif not archived_before or att["fecha"] >= archived_before or record_id in live_ids:
+                continue
+            counts = counters.setdefault((att["alumnoId"], att["materiaId"]), {"presente": 0, "ausente": 0, "justificado": 0})
+            if att["estado"] in counts:
+                counts[att["estado"]] += 1
+
+        subject_names = {}
+        for _, materiaId in counters:
+            if materiaId not in subject_names:
+                subject_doc = db.collection("subjects").document(materiaId).get()
+                subject_names[materiaId] = subject_doc.to_dict().get("nombre", "") if subject_doc.exists else ""
+
+        chunks = 0
+        rows = []
+        for (alumnoId, materiaId), counts in sorted(counters.items(), key=lambda item: (students[item[0][0]], item[0][1])):
+            gradoId, nombreCompleto = students[alumnoId]
+            total = sum(counts.values())
+            rows.append([
+                gradoId, alumnoId, nombreCompleto, materiaId, subject_names[materiaId], total,
+                counts["presente"], counts["ausente"], counts["justificado"],
+                f"{counts['ausente'] / total:.4f}" if total else "0.0000",
+            ])
+            if len(rows) == report_rows_per_chunk:
+                write_report_chunk(job_id, chunks, rows)
+                chunks, rows = chunks + 1, []
+        if rows:
+            write_report_chunk(job_id, chunks, rows)
+            chunks += 1
+
+        if not transition_report_job(job_id, "running", status="completed", processedRecords=processed, rows=len(counters), chunks=chunks, finishedAt=datetime.now(timezone.utc)):
+            print(f"El reporte {job_id} terminó pero ya no estaba en curso (vencido o eliminado)")
+    except Exception as e:
+        print(f"Error generando el reporte {job_id}: {str(e)}")
+        try:
+            transition_report_job(job_id, "running", status="failed", error=str(e), finishedAt=datetime.now(timezone.utc))
+        except Exception as status_error:
+            print(f"No se pudo marcar como fallido el reporte {job_id}: {str(status_error)}")
+
+def get_report_job(job_id: str):
+    job_ref = db.collection("report_jobs").document(job_id)
+    job_doc = job_ref.get()
+    if not job_doc.exists:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    job = job_doc.to_dict()
+
+    now = datetime.now(timezone.utc)
+    if job["updatedAt"] < now - timedelta(hours=report_job_ttl_hours):
+        delete_report_job(job_ref)
+        raise HTTPException(status_code=404, detail="Report job not found")
+    # Un trabajo sin actividad reciente quedó detenido (proceso reiniciado o congelado)
+    if job["status"] in ("pending", "running") and job["updatedAt"] < now - timedelta(minutes=report_job_timeout_minutes):
+        if transition_report_job(job_id, job["status"], status="failed", error="Report job timed out", finishedAt=now):
+            job.update(status="failed", error="Report job timed out", finishedAt=now)
+        else:
+            # El trabajo cambió de estado (o se eliminó) mientras tanto
+            job_doc = job_ref.get()
+            if not job_doc.exists:
+                raise HTTPException(status_code=404, detail="Report job not found")
+            job = job_doc.to_dict()
+    return job
+
+@app.post("/reports/attendance", status_code=202)
+def create_attendance_report(report: AttendanceReportRequest):
+    fecha_inicio = as_utc(report.fechaInicio)
+    fecha_fin = as_utc(report.fechaFin)
+    if fecha_fin < fecha_inicio:
+        raise HTTPException(status_code=400, detail="fechaFin must be after fechaInicio")
+    if not report.gradoIds:
+        raise HTTPException(status_code=400, detail="At least one gradoId is required")
+
+    cleanup_expired_report_jobs()
+
+    job_id = uuid.uuid4().hex
+    now = datetime.now(timezone.utc)
+    db.collection("report_jobs").document(job_id).set({
+        "jobId": job_id,
+        "status": "pending",
+        "fechaInicio": fecha_inicio,
+        "fechaFin": fecha_fin,
+        "gradoIds": report.gradoIds,
+        "processedRecords": 0,
+        "createdAt": now,
+        "updatedAt": now,
+    })
+    report_executor.submit(run_attendance_report, job_id, fecha_inicio, fecha_fin, report.gradoIds)
+    return {"jobId": job_id, "status": "pending", "message": "Report job created successfully"}
+
+@app.get("/reports/attendance/{job_id}")
+def get_attendance_report_status(job_id: str):
+    job = get_report_job(job_id)
+    if job["status"] == "completed":
+        job["downloadUrl"] = f"/reports/attendance/{job_id}/download"
+    return job
+
+@app.get("/reports/attendance/{job_id}/download")
+def download_attendance_report(job_id: str):
+    job = get_report_job(job_id)
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Report job is {job['status']}")
+
+    def iter_csv():
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(report_columns)
+        yield buffer.getvalue()
+        for chunk in db.collection("report_jobs").document(job_id).collection("chunks").order_by("index").stream():
+            yield chunk.to_dict()["csv"]
+
+    return StreamingResponse(
+        iter_csv(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="attendance_report_{job_id}.csv"'},
+    )
+
+
 @app.get("/students/paginated")
 def get_students_paginated(page: int = Query(1, ge=1), page_size: int = Query(10, ge=1, le=100)):
     start = time.time()
@@ -726,6 +1292,10 @@ def get_users_paginated(page: int = Query(1, ge=1), page_size: int = Query(10, g
 
 @app.get("/notifications/paginated")
 def get_notifications_paginated(page: int = Query(1, ge=1), page_size: int = Query(10, ge=1, le=100)):
+    """
+    Pagina solo las notificaciones no archivadas (dentro del periodo de retención).
+    Para incluir las archivadas usar `/notifications` con un rango de fechas.
+    """
     start = time.time()
     notifications_ref = db.collection("notifications")
     notifications_query = notifications_ref.offset((page - 1) * page_size).limit(page_size).stream()